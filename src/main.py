@@ -9,14 +9,21 @@ AWS Resource Auditor & Self-Analyzing Batch Job
 Designed to run on AWS Batch with Fargate.
 """
 
+import copy
+import gzip
+import io
 import json
 import logging
 import os
 import time
 import sys
+import urllib.request
+from collections import defaultdict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
-import boto3
+import orjson
 from botocore.exceptions import ClientError
 
 # Configure logging to stdout (critical for CloudWatch)
@@ -27,63 +34,146 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Maximum number of values EC2 accepts in a single filter
+SG_FILTER_CHUNK_SIZE = 200
+
+# SSH and RDP must not be reachable from anywhere
+RISKY_PORTS = frozenset({22, 3389})
+ANY_CIDR = '0.0.0.0/0'
+
+# Worker threads for concurrent AWS API calls; the client connection pools are sized to match
+MAX_WORKERS = 16
+AWS_CLIENT_CONFIG = {
+    'max_pool_connections': 2 * MAX_WORKERS,
+    'retries': {'mode': 'adaptive', 'max_attempts': 10},
+    'tcp_keepalive': True
+}
+
+# The audit report and summary are uploaded concurrently, each split into concurrent parts once large enough
+S3_UPLOAD_WORKERS = 2
+S3_TRANSFER_CONFIG = {
+    'multipart_threshold': 8 * 1024 * 1024,
+    'multipart_chunksize': 8 * 1024 * 1024,
+    'max_concurrency': 8
+}
+
+# Seconds to wait between checks for this job's log events while logs are ingested
+# Capped at 5 seconds in total, the fixed ingestion pause this replaced
+LOG_POLL_DELAYS = (0.5, 1, 1.5, 2)
+
+# Free tier eligible instance types
+FREE_TIER_TYPES = frozenset({'t2.micro', 't3.micro', 't4g.micro'})
+FREE_TIER_TYPES_MSG = ', '.join(sorted(FREE_TIER_TYPES))
+
+# Reports are pretty-printed and log lines compact; UTC datetimes are rendered with a trailing Z
+# Dataclasses go through the default hook so findings keep the report's key names
+LOG_JSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_PASSTHROUGH_DATACLASS
+REPORT_JSON_OPTIONS = LOG_JSON_OPTIONS | orjson.OPT_INDENT_2
+
+# Reports larger than this are gzip-compressed before upload
+GZIP_MIN_BYTES = 4096
+GZIP_COMPRESS_LEVEL = 5
+
+
+@dataclass(slots=True, frozen=True)
+class SecurityGroupIssue:
+    """A security group rule exposing SSH/RDP to anywhere."""
+    security_group_id: str
+    port: int
+    protocol: str
+    cidr: str
+
+    def to_dict(self):
+        """Return the issue in the report's JSON shape."""
+        return {
+            'SecurityGroupId': self.security_group_id,
+            'Port': self.port,
+            'Protocol': self.protocol,
+            'CIDR': self.cidr
+        }
+
 
 def get_aws_clients():
     """Initializes and returns AWS clients for the audit and for CloudWatch Logs."""
     region = os.getenv('AWS_REGION', 'us-east-1')
     logger.info(f"Initializing AWS clients in region: {region}")
 
+    # boto3 is slow to import, so it is only loaded once clients are actually needed
+    import boto3
+    from botocore.config import Config
+
+    # One session resolves credentials and loads endpoint data once for all clients
+    session = boto3.session.Session(region_name=region)
+    # botocore rewrites the nested retries dict, so never hand it the module-level constant
+    config = Config(**copy.deepcopy(AWS_CLIENT_CONFIG))
+
     return (
-        boto3.client('ec2', region_name=region),
-        boto3.client('s3', region_name=region),
-        boto3.client('logs', region_name=region)  # For self-analysis
+        session.client('ec2', config=config),
+        session.client('s3', config=config),
+        session.client('logs', config=config)  # For self-analysis
     )
 
 
 def get_ec2_instances(ec2_client):
-    """Retrieve all EC2 instances in the region."""
-    try:
-        logger.info("Fetching EC2 instances...")
-        response = ec2_client.describe_instances()
-        instances = []
+    """Yield all EC2 instances in the region page by page; API errors propagate to the consumer."""
+    count = 0
+    paginator = ec2_client.get_paginator('describe_instances')
 
-        for reservation in response['Reservations']:
+    for page in paginator.paginate(PaginationConfig={'PageSize': 1000}):
+        for reservation in page['Reservations']:
             for instance in reservation['Instances']:
-                instances.append(instance)
+                count += 1
+                yield instance
 
-        logger.info(f"Found {len(instances)} EC2 instances.")
-        return instances
-    except ClientError as e:
-        logger.error(f"Error fetching EC2 instances: {e}")
-        return []
+    logger.info(f"Found {count} EC2 instances.")
 
 
-def check_security_groups(ec2_client, instance):
-    """Check if instance has security groups allowing SSH/RDP from anywhere."""
-    security_issues = []
+def _fetch_security_group_issues(ec2_client, sg_ids):
+    """Fetch rules for one chunk of security groups and flag SSH/RDP open to anywhere."""
+    sg_issues = {}
+
+    try:
+        paginator = ec2_client.get_paginator('describe_security_group_rules')
+
+        for page in paginator.paginate(Filters=[{'Name': 'group-id', 'Values': sg_ids}]):
+            for rule in page['SecurityGroupRules']:
+                # Cheapest checks first; most rules are rejected on protocol or port
+                if rule.get('IpProtocol') != 'tcp':
+                    continue
+                if rule.get('FromPort') not in RISKY_PORTS:
+                    continue
+                if rule.get('CidrIpv4') != ANY_CIDR:
+                    continue
+
+                sg_issues.setdefault(rule['GroupId'], []).append(SecurityGroupIssue(
+                    security_group_id=rule['GroupId'],
+                    port=rule['FromPort'],
+                    protocol=rule['IpProtocol'],
+                    cidr=rule['CidrIpv4']
+                ))
+    except ClientError as e:
+        logger.error(f"Error checking security groups {', '.join(sg_ids)}: {e}")
+
+    return sg_issues
 
-    for sg in instance.get('SecurityGroups', []):
-        sg_id = sg['GroupId']
 
-        try:
-            sg_response = ec2_client.describe_security_group_rules(
-                Filters=[{'Name': 'group-id', 'Values': [sg_id]}]
-            )
+def get_security_group_issues(ec2_client, sg_ids):
+    """Fetch rules for all security groups in bulk, one concurrent request per chunk."""
+    sg_issues = {}
+    sg_ids = list(sg_ids)
+    chunks = [sg_ids[i:i + SG_FILTER_CHUNK_SIZE] for i in range(0, len(sg_ids), SG_FILTER_CHUNK_SIZE)]
+    if not chunks:
+        return sg_issues
+    if len(chunks) == 1:
+        return _fetch_security_group_issues(ec2_client, chunks[0])
 
-            for rule in sg_response['SecurityGroupRules']:
-                if (rule.get('FromPort') in [22, 3389] and
-                        rule.get('IpProtocol') == 'tcp'):
-                    if '0.0.0.0/0' in rule.get('CidrIpv4', ''):
-                        security_issues.append({
-                            'SecurityGroupId': sg_id,
-                            'Port': rule['FromPort'],
-                            'Protocol': rule['IpProtocol'],
-                            'CIDR': rule.get('CidrIpv4')
-                        })
-        except ClientError as e:
-            logger.error(f"Error checking security group {sg_id}: {e}")
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(chunks))) as executor:
+        futures = [executor.submit(_fetch_security_group_issues, ec2_client, chunk) for chunk in chunks]
+        # Merge in submission order so findings are ordered the same on every run
+        for future in futures:
+            sg_issues.update(future.result())
 
-    return security_issues
+    return sg_issues
 
 
 def check_instance_utilization(instance):
@@ -102,12 +192,11 @@ def check_instance_utilization(instance):
         })
 
     # Simple, free-tier friendly check: flag if instance is not using free tier eligible types
-    free_tier_types = ['t2.micro', 't3.micro', 't4g.micro']
     instance_type = instance['InstanceType']
-    if instance_type not in free_tier_types and state == 'running':
+    if instance_type not in FREE_TIER_TYPES and state == 'running':
         utilization_issues.append({
             'issue': 'NON_FREE_TIER_TYPE',
-            'message': f'Instance type {instance_type} may incur costs. Free tier types: {", ".join(free_tier_types)}',
+            'message': f'Instance type {instance_type} may incur costs. Free tier types: {FREE_TIER_TYPES_MSG}',
             'instance_id': instance_id,
             'current_type': instance_type,
         })
@@ -115,106 +204,192 @@ def check_instance_utilization(instance):
     return utilization_issues
 
 
-def generate_audit_report(ec2_client, instances):
+def generate_audit_report(ec2_client, instances, run_time):
     """Generate the core EC2 audit report."""
     logger.info("Generating EC2 audit report...")
-    report = {
-        'audit_timestamp': datetime.utcnow().isoformat(),
+    security_findings = []
+    utilization_findings = []
+
+    # Collect every security group up front so rules can be fetched in bulk
+    sg_to_instances = defaultdict(list)
+    instance_ids = []
+    instance_list_complete = True
+
+    try:
+        for instance in instances:
+            instance_id = instance['InstanceId']
+
+            for sg in instance.get('SecurityGroups', []):
+                sg_to_instances[sg['GroupId']].append(instance_id)
+            instance_ids.append(instance_id)
+
+            # Check utilization
+            utilization_issues = check_instance_utilization(instance)
+            if utilization_issues:
+                utilization_findings.append({
+                    'instance_id': instance_id,
+                    'issues': utilization_issues
+                })
+    except ClientError as e:
+        # Keep auditing what was fetched, but flag that the instance list is partial
+        logger.error(f"Error fetching EC2 instances after {len(instance_ids)} instances: {e}")
+        instance_list_complete = False
+
+    # Check security groups
+    sg_issues = get_security_group_issues(ec2_client, sg_to_instances)
+    logger.info(f"Found {len(sg_issues)} of {len(sg_to_instances)} security groups with open SSH/RDP.")
+
+    instance_security_issues = defaultdict(list)
+    for sg_id, issues in sg_issues.items():
+        for instance_id in sg_to_instances[sg_id]:
+            instance_security_issues[instance_id].extend(issues)
+
+    for instance_id in instance_ids:
+        security_issues = instance_security_issues.get(instance_id)
+        if security_issues:
+            security_findings.append({
+                'instance_id': instance_id,
+                'issues': security_issues
+            })
+
+    # Summary counts are derived once from the collected findings
+    return {
+        'audit_timestamp': run_time,
         'findings': {
-            'security_issues': [],
-            'utilization_issues': []
+            'security_issues': security_findings,
+            'utilization_issues': utilization_findings
         },
         'summary': {
-            'total_instances': len(instances),
-            'instances_with_security_issues': 0,
-            'instances_with_utilization_issues': 0
+            'total_instances': len(instance_ids),
+            'instance_list_complete': instance_list_complete,
+            'instances_with_security_issues': len(security_findings),
+            'instances_with_utilization_issues': len(utilization_findings)
         }
     }
 
-    for instance in instances:
-        instance_id = instance['InstanceId']
 
-        # Check security groups
-        security_issues = check_security_groups(ec2_client, instance)
-        if security_issues:
-            report['findings']['security_issues'].append({
-                'instance_id': instance_id,
-                'issues': security_issues
-            })
-            report['summary']['instances_with_security_issues'] += 1
+def _json_default(obj):
+    """Serialize values orjson does not handle natively."""
+    if isinstance(obj, SecurityGroupIssue):
+        return obj.to_dict()
+    return str(obj)
+
+
+def format_timestamp(timestamp):
+    """Format a datetime exactly as it appears in the JSON reports."""
+    return timestamp.isoformat().replace('+00:00', 'Z')
 
-        # Check utilization
-        utilization_issues = check_instance_utilization(instance)
-        if utilization_issues:
-            report['findings']['utilization_issues'].append({
-                'instance_id': instance_id,
-                'issues': utilization_issues
-            })
-            report['summary']['instances_with_utilization_issues'] += 1
 
-    return report
+def dumps_report(report, option=REPORT_JSON_OPTIONS):
+    """Serialize a report to JSON bytes, ready to upload."""
+    return orjson.dumps(report, default=_json_default, option=option)
 
 
-def upload_to_s3(s3_client, content, key_suffix, content_type, bucket_name):
-    """Upload a report to S3."""
+def upload_to_s3(s3_client, content, key_suffix, content_type, bucket_name, run_slug):
+    """Upload a report to S3, gzip-compressing larger payloads."""
+    from boto3.exceptions import S3UploadFailedError
+    from boto3.s3.transfer import TransferConfig
+
     try:
-        key = f"audit-reports/ec2-audit-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{key_suffix}"
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=key,
-            Body=content,
-            ContentType=content_type
+        key = f"audit-reports/ec2-audit-{run_slug}-{key_suffix}"
+        extra_args = {'ContentType': content_type}
+
+        if isinstance(content, str):
+            content = content.encode()
+        if len(content) > GZIP_MIN_BYTES:
+            content = gzip.compress(content, compresslevel=GZIP_COMPRESS_LEVEL)
+            key += '.gz'
+            extra_args['ContentEncoding'] = 'gzip'
+
+        # Payloads above the threshold are sent as concurrent multipart uploads
+        s3_client.upload_fileobj(
+            io.BytesIO(content),
+            bucket_name,
+            key,
+            ExtraArgs=extra_args,
+            Config=TransferConfig(**S3_TRANSFER_CONFIG)
         )
         logger.info(f"Uploaded to S3: {key}")
         return key
-    except ClientError as e:
+    except (ClientError, S3UploadFailedError) as e:
         logger.error(f"Error uploading to S3: {e}")
         return None
 
 
-def analyze_own_logs(logs_client, job_id):
-    """Fetches and analyzes the CloudWatch Logs for this job (self-analysis)."""
-    log_group_name = os.getenv('AWS_BATCH_LOG_GROUP_NAME', '/aws/batch/job')
-    log_stream_prefix = job_id
+def scan_log_events(logs_client, log_group_name, log_stream_prefix, start_time_ms):
+    """Analyze this job's log events in a single streamed pass over the log group."""
+    total_log_events = error_count = warning_count = 0
+    first_log_event = last_log_event = None
+    successful_completion = False
 
-    try:
-        # Find the log stream for this job
-        response = logs_client.describe_log_streams(
-            logGroupName=log_group_name,
-            logStreamNamePrefix=log_stream_prefix,
-            orderBy='LastEventTime',
-            descending=True,
-            limit=1
-        )
+    paginator = logs_client.get_paginator('filter_log_events')
+    pages = paginator.paginate(
+        logGroupName=log_group_name,
+        logStreamNamePrefix=log_stream_prefix,
+        startTime=start_time_ms
+    )
 
-        if not response['logStreams']:
-            return {"error": "No log stream found for self-analysis."}
+    for page in pages:
+        for event in page['events']:
+            message = event['message']
+            if first_log_event is None:
+                first_log_event = message
+            last_log_event = message
+            total_log_events += 1
+
+            if 'ERROR' in message:
+                error_count += 1
+            if 'WARNING' in message:
+                warning_count += 1
+            if not successful_completion and 'FINAL JOB SUMMARY' in message:
+                successful_completion = True
+
+    return {
+        'total_log_events': total_log_events,
+        'error_count': error_count,
+        'warning_count': warning_count,
+        'first_log_event': first_log_event,
+        'last_log_event': last_log_event,
+        'successful_completion': successful_completion
+    }
 
-        log_stream_name = response['logStreams'][0]['logStreamName']
-        logger.info(f"Found own log stream: {log_stream_name}")
 
-        # Get the log events
-        log_response = logs_client.get_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            startFromHead=False
-        )
+def get_log_stream_prefix(job_id):
+    """Return this job's awslogs stream name, <prefix>/default/<task-id>, falling back to the job ID."""
+    stream_prefix = os.getenv('AWS_BATCH_LOG_STREAM_PREFIX')
+    metadata_uri = os.getenv('ECS_CONTAINER_METADATA_URI_V4')
+    if not stream_prefix or not metadata_uri:
+        return job_id
 
-        events = log_response['events']
-        log_messages = [event['message'] for event in events]
-
-        # Perform analysis
-        analysis = {
-            'log_analysis_timestamp': datetime.utcnow().isoformat(),
-            'total_log_events': len(events),
-            'error_count': sum(1 for msg in log_messages if 'ERROR' in msg),
-            'warning_count': sum(1 for msg in log_messages if 'WARNING' in msg),
-            'first_log_event': events[-1]['message'] if events else None,
-            'last_log_event': events[0]['message'] if events else None,
-            'successful_completion': any("FINAL JOB SUMMARY" in msg for msg in log_messages)
-        }
+    try:
+        with urllib.request.urlopen(f"{metadata_uri}/task", timeout=2) as response:
+            task_arn = json.load(response)['TaskARN']
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Could not read ECS task metadata, using job ID as log stream prefix: {e}")
+        return job_id
+
+    return f"{stream_prefix}/default/{task_arn.rsplit('/', 1)[-1]}"
+
+
+def analyze_own_logs(logs_client, job_id, run_time):
+    """Fetches and analyzes the CloudWatch Logs for this job (self-analysis)."""
+    log_group_name = os.getenv('AWS_BATCH_LOG_GROUP_NAME', '/aws/batch/job')
+    log_stream_prefix = get_log_stream_prefix(job_id)
+    # Only events written since this job started are relevant
+    start_time_ms = int(run_time.timestamp() * 1000)
 
-        return analysis
+    try:
+        # Retry with backoff until this job's events have been ingested
+        for delay in (*LOG_POLL_DELAYS, None):
+            analysis = scan_log_events(logs_client, log_group_name, log_stream_prefix, start_time_ms)
+            if analysis['total_log_events']:
+                break
+            if delay is None:
+                return {"error": "No log events found for self-analysis."}
+            time.sleep(delay)
+
+        logger.info(f"Analyzed {analysis['total_log_events']} own log events.")
+        return {'log_analysis_timestamp': datetime.now(timezone.utc), **analysis}
 
     except ClientError as e:
         logger.error(f"Error during self-analysis of logs: {e}")
@@ -224,6 +399,9 @@ def analyze_own_logs(logs_client, job_id):
 def main():
     """Main function to run the combined audit and self-analysis."""
     start_time = time.time()
+    # Single timestamp shared by every report and S3 key of this run
+    run_time = datetime.fromtimestamp(start_time, timezone.utc)
+    run_slug = run_time.strftime('%Y%m%d-%H%M%S')
     job_id = os.getenv('AWS_BATCH_JOB_ID', 'local-test-job-id')
     s3_bucket_name = os.getenv('S3_BUCKET_NAME', 'aws-batch-audit-reports')
 
@@ -235,31 +413,42 @@ def main():
     ec2_client, s3_client, logs_client = get_aws_clients()
 
     # --- PHASE 1: Perform EC2 Audit ---
+    logger.info("Fetching EC2 instances...")
     instances = get_ec2_instances(ec2_client)
-    audit_report = generate_audit_report(ec2_client, instances)
-
-    # Upload JSON audit report
-    audit_json = json.dumps(audit_report, indent=2)
-    upload_to_s3(s3_client, audit_json, 'report.json', 'application/json', s3_bucket_name)
+    audit_report = generate_audit_report(ec2_client, instances, run_time)
 
-    # Generate and upload Markdown summary
+    # Generate the JSON audit report and Markdown summary
+    audit_json = dumps_report(audit_report)
     markdown_content = [
         "# AWS EC2 Instance Audit Report",
-        f"**Generated:** {audit_report['audit_timestamp']}",
+        f"**Generated:** {format_timestamp(audit_report['audit_timestamp'])}",
         f"**Job ID:** {job_id}",
         "",
         "## Summary",
         f"- Total Instances: {audit_report['summary']['total_instances']}",
+        f"- Instance List Complete: {'Yes' if audit_report['summary']['instance_list_complete'] else 'No'}",
         f"- Instances with Security Issues: {audit_report['summary']['instances_with_security_issues']}",
         f"- Instances with Utilization Issues: {audit_report['summary']['instances_with_utilization_issues']}",
     ]
     markdown_report = "\n".join(markdown_content)
-    upload_to_s3(s3_client, markdown_report, 'summary.md', 'text/markdown', s3_bucket_name)
+
+    # Upload both reports concurrently, and finish before self-analysis so upload errors are counted in the logs
+    audit_uploads = [
+        (audit_json, 'report.json', 'application/json'),
+        (markdown_report, 'summary.md', 'text/markdown'),
+    ]
+    with ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS) as upload_executor:
+        futures = [
+            upload_executor.submit(upload_to_s3, s3_client, content, key_suffix, content_type, s3_bucket_name, run_slug)
+            for content, key_suffix, content_type in audit_uploads
+        ]
+        failed_uploads = [
+            key_suffix for (_, key_suffix, _), future in zip(audit_uploads, futures) if future.result() is None
+        ]
 
     # --- PHASE 2: Self-Analysis via CloudWatch Logs ---
     logger.info("🔍 Beginning self-analysis via CloudWatch Logs...")
-    time.sleep(5)  # Brief pause for log ingestion
-    log_analysis = analyze_own_logs(logs_client, job_id)
+    log_analysis = analyze_own_logs(logs_client, job_id, run_time)
 
     # --- PHASE 3: Generate Final Combined Report ---
     end_time = time.time()
@@ -270,19 +459,27 @@ def main():
         'execution_duration_seconds': round(execution_duration, 2),
         'audit_summary': audit_report['summary'],
         'operational_metrics': {
-            'start_time': datetime.fromtimestamp(start_time, timezone.utc).isoformat(),
-            'end_time': datetime.fromtimestamp(end_time, timezone.utc).isoformat(),
+            'start_time': run_time,
+            'end_time': datetime.fromtimestamp(end_time, timezone.utc),
+            'failed_uploads': failed_uploads,
             'log_analysis': log_analysis
         },
         'status': 'SUCCESS' if log_analysis.get('successful_completion') else 'ANALYSIS_COMPLETED_WITH_WARNINGS'
     }
 
     # Upload the final combined report
-    final_report_json = json.dumps(final_report, indent=2)
-    upload_to_s3(s3_client, final_report_json, 'final-combined-report.json', 'application/json', s3_bucket_name)
+    final_report_json = dumps_report(final_report)
+    if upload_to_s3(s3_client, final_report_json, 'final-combined-report.json', 'application/json',
+                    s3_bucket_name, run_slug) is None:
+        # Reported separately so the logged summary matches the uploaded one
+        failed_uploads = [*failed_uploads, 'final-combined-report.json']
+
+    if failed_uploads:
+        logger.error(f"Report uploads to S3 failed: {', '.join(failed_uploads)}")
 
     # Log the final summary
-    logger.info(f"📈 FINAL JOB SUMMARY: {json.dumps(final_report, indent=2)}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("📈 FINAL JOB SUMMARY: %s", dumps_report(final_report, option=LOG_JSON_OPTIONS).decode())
     logger.info("🏁 Combined audit and self-analysis job finished successfully.")
 
     # Exit successfully
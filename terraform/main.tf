@@ -143,6 +143,10 @@ resource "aws_batch_job_definition" "ec2_auditor_job" {
       {
         name  = "AWS_REGION"
         value = var.region
+      },
+      {
+        name  = "AWS_BATCH_LOG_STREAM_PREFIX"
+        value = var.project_name
       }
     ]
     logConfiguration = {
@@ -1,30 +1,49 @@
 """Integration tests for AWS Resource Auditor main functionality."""
+import gzip
+import io
 import json
 import os
 import sys
 import pytest
+from datetime import datetime, timezone
 from unittest.mock import patch, MagicMock
 
 # Add the project root to Python path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../..'))
 
+RUN_TIME = datetime(2024, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+RUN_SLUG = RUN_TIME.strftime('%Y%m%d-%H%M%S')
+
 def test_get_aws_clients():
     """Test that AWS clients can be created."""
     from src.main import get_aws_clients
     
-    with patch('src.main.boto3.client') as mock_client:
+    with patch('boto3.session.Session') as mock_session:
         mock_ec2 = MagicMock()
         mock_s3 = MagicMock()
         mock_logs = MagicMock()
         
-        mock_client.side_effect = [mock_ec2, mock_s3, mock_logs]
+        mock_session.return_value.client.side_effect = [mock_ec2, mock_s3, mock_logs]
         
         ec2, s3, logs = get_aws_clients()
         
+        # All clients share a single session
+        mock_session.assert_called_once()
         assert ec2 == mock_ec2
         assert s3 == mock_s3
         assert logs == mock_logs
 
+def test_get_aws_clients_leaves_config_unchanged():
+    """Test building real clients does not mutate the shared client settings."""
+    from src.main import AWS_CLIENT_CONFIG, get_aws_clients
+    
+    with patch.dict(os.environ, {'AWS_REGION': 'us-east-1'}):
+        ec2, _, _ = get_aws_clients()
+        get_aws_clients()
+    
+    assert AWS_CLIENT_CONFIG['retries'] == {'mode': 'adaptive', 'max_attempts': 10}
+    assert ec2.meta.config.retries['mode'] == 'adaptive'
+
 def test_check_instance_utilization():
     """Test instance utilization checking."""
     from src.main import check_instance_utilization
@@ -41,14 +60,12 @@ def test_check_instance_utilization():
     assert len(issues) == 1
     assert issues[0]['issue'] == 'STOPPED_INSTANCE'
 
-@patch('src.main.boto3.client')
-def test_get_ec2_instances(mock_client):
+def test_get_ec2_instances():
     """Test retrieving EC2 instances."""
     from src.main import get_ec2_instances
     
     # Mock EC2 client and response
     mock_ec2 = MagicMock()
-    mock_client.return_value = mock_ec2
     
     mock_response = {
         'Reservations': [
@@ -64,26 +81,76 @@ def test_get_ec2_instances(mock_client):
             }
         ]
     }
-    mock_ec2.describe_instances.return_value = mock_response
+    mock_ec2.get_paginator.return_value.paginate.return_value = [mock_response]
     
-    instances = get_ec2_instances(mock_ec2)
+    instances = list(get_ec2_instances(mock_ec2))
+    mock_ec2.get_paginator.assert_called_once_with('describe_instances')
     assert len(instances) == 1
     assert instances[0]['InstanceType'] == 't2.micro'
 
+def test_generate_audit_report_partial_instance_list():
+    """Test a failure part-way through pagination marks the report incomplete."""
+    from botocore.exceptions import ClientError
+    from src.main import generate_audit_report, get_ec2_instances
+    
+    def pages(**kwargs):
+        yield {'Reservations': [{'Instances': [{
+            'InstanceId': 'i-1234567890abcdef0',
+            'State': {'Name': 'running'},
+            'InstanceType': 't2.micro'
+        }]}]}
+        raise ClientError({'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Throttled'}}, 'DescribeInstances')
+    
+    mock_ec2 = MagicMock()
+    mock_ec2.get_paginator.return_value.paginate.side_effect = pages
+    
+    report = generate_audit_report(mock_ec2, get_ec2_instances(mock_ec2), RUN_TIME)
+    
+    assert report['summary']['total_instances'] == 1
+    assert report['summary']['instance_list_complete'] is False
+
 def test_upload_to_s3():
     """Test uploading reports to S3."""
     from src.main import upload_to_s3
     
     # Mock S3 client
     mock_s3 = MagicMock()
-    mock_s3.put_object.return_value = {}
     
     test_content = json.dumps({'test': 'data'})
-    key = upload_to_s3(mock_s3, test_content, 'test.json', 'application/json', 'test-bucket')
+    key = upload_to_s3(mock_s3, test_content, 'test.json', 'application/json', 'test-bucket', RUN_SLUG)
+    
+    assert key == 'audit-reports/ec2-audit-20240101-120000-test.json'
+    mock_s3.upload_fileobj.assert_called_once()
+    fileobj, bucket, uploaded_key = mock_s3.upload_fileobj.call_args.args
+    assert (bucket, uploaded_key) == ('test-bucket', key)
+    assert fileobj.getvalue().decode() == test_content
+    assert mock_s3.upload_fileobj.call_args.kwargs['ExtraArgs'] == {'ContentType': 'application/json'}
+
+def test_upload_to_s3_compresses_large_reports():
+    """Test large reports are gzip-compressed before upload."""
+    from src.main import upload_to_s3
+    
+    mock_s3 = MagicMock()
+    
+    test_content = json.dumps({'findings': ['issue'] * 2000})
+    key = upload_to_s3(mock_s3, test_content, 'test.json', 'application/json', 'test-bucket', RUN_SLUG)
+    
+    fileobj, _, uploaded_key = mock_s3.upload_fileobj.call_args.args
+    extra_args = mock_s3.upload_fileobj.call_args.kwargs['ExtraArgs']
+    assert key.endswith('test.json.gz')
+    assert uploaded_key == key
+    assert extra_args == {'ContentType': 'application/json', 'ContentEncoding': 'gzip'}
+    assert gzip.decompress(fileobj.getvalue()).decode() == test_content
+
+def test_upload_to_s3_failure():
+    """Test a failed upload is logged and reported as no key."""
+    from boto3.exceptions import S3UploadFailedError
+    from src.main import upload_to_s3
+    
+    mock_s3 = MagicMock()
+    mock_s3.upload_fileobj.side_effect = S3UploadFailedError('Access Denied')
     
-    assert key is not None
-    assert key.startswith('audit-reports/')
-    mock_s3.put_object.assert_called_once()
+    assert upload_to_s3(mock_s3, 'data', 'test.json', 'application/json', 'test-bucket', RUN_SLUG) is None
 
 def test_analyze_own_logs():
     """Test analyzing CloudWatch logs."""
@@ -91,31 +158,96 @@ def test_analyze_own_logs():
     
     # Mock logs client
     mock_logs = MagicMock()
-    mock_logs.describe_log_streams.return_value = {
-        'logStreams': [{'logStreamName': 'test-stream'}]
-    }
-    mock_logs.get_log_events.return_value = {
-        'events': [
-            {'message': 'INFO: Test message'},
-            {'message': 'ERROR: Test error'}
-        ]
-    }
+    mock_logs.get_paginator.return_value.paginate.return_value = [
+        {'events': [{'message': 'INFO: Test message'}, {'message': 'ERROR: Test error'}]},
+        {'events': [{'message': 'ERROR: Another error after a WARNING'}]},
+    ]
     
     with patch('src.main.os.getenv') as mock_getenv:
-        mock_getenv.return_value = '/aws/batch/job'
-        analysis = analyze_own_logs(mock_logs, 'test-job-123')
+        # Only the log group is configured; there is no ECS task metadata outside a container
+        mock_getenv.side_effect = lambda key, default=None: (
+            '/aws/batch/job' if key == 'AWS_BATCH_LOG_GROUP_NAME' else default
+        )
+        analysis = analyze_own_logs(mock_logs, 'test-job-123', RUN_TIME)
         
-        assert analysis['total_log_events'] == 2
-        assert analysis['error_count'] == 1
+        mock_logs.get_paginator.assert_called_with('filter_log_events')
+        mock_logs.get_paginator.return_value.paginate.assert_called_with(
+            logGroupName='/aws/batch/job',
+            logStreamNamePrefix='test-job-123',
+            startTime=int(RUN_TIME.timestamp() * 1000)
+        )
+        mock_logs.describe_log_streams.assert_not_called()
+        assert analysis['total_log_events'] == 3
+        # The analysis is timestamped when it completes, not at job start
+        assert analysis['log_analysis_timestamp'] > RUN_TIME
+        assert analysis['first_log_event'] == 'INFO: Test message'
+        assert analysis['last_log_event'] == 'ERROR: Another error after a WARNING'
+        assert analysis['error_count'] == 2
+        assert analysis['warning_count'] == 1
+        assert analysis['successful_completion'] is False
+
+@patch('src.main.time.sleep')
+def test_analyze_own_logs_waits_for_ingestion(mock_sleep):
+    """Test self-analysis backs off until the job's log events appear."""
+    from src.main import analyze_own_logs
+    
+    mock_logs = MagicMock()
+    mock_logs.get_paginator.return_value.paginate.side_effect = [
+        [{'events': []}],
+        [{'events': []}],
+        [{'events': [{'message': 'INFO: Test message'}]}],
+    ]
+    
+    analysis = analyze_own_logs(mock_logs, 'test-job-123', RUN_TIME)
+    
+    assert analysis['total_log_events'] == 1
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [0.5, 1]
 
-@patch('src.main.boto3.client')
-def test_generate_audit_report(mock_client):
+@patch('src.main.time.sleep')
+def test_analyze_own_logs_gives_up(mock_sleep):
+    """Test self-analysis stops polling once every backoff delay is used."""
+    from src.main import LOG_POLL_DELAYS, analyze_own_logs
+    
+    mock_logs = MagicMock()
+    mock_logs.get_paginator.return_value.paginate.return_value = [{'events': []}]
+    
+    analysis = analyze_own_logs(mock_logs, 'test-job-123', RUN_TIME)
+    
+    assert 'error' in analysis
+    assert mock_logs.get_paginator.return_value.paginate.call_count == len(LOG_POLL_DELAYS) + 1
+    # Never waits longer than the fixed 5 second pause it replaced
+    assert sum(c.args[0] for c in mock_sleep.call_args_list) <= 5
+
+def test_get_log_stream_prefix_from_task_metadata():
+    """Test the log stream prefix follows the awslogs <prefix>/default/<task-id> naming."""
+    from src.main import get_log_stream_prefix
+    
+    env = {
+        'AWS_BATCH_LOG_STREAM_PREFIX': 'aws-batch-auditor',
+        'ECS_CONTAINER_METADATA_URI_V4': 'http://169.254.170.2/v4/abc',
+    }
+    metadata = MagicMock()
+    metadata.__enter__.return_value = io.BytesIO(
+        json.dumps({'TaskARN': 'arn:aws:ecs:us-east-1:123456789012:task/cluster/0123abcd'}).encode()
+    )
+    
+    with patch.dict(os.environ, env), patch('src.main.urllib.request.urlopen', return_value=metadata) as mock_open:
+        assert get_log_stream_prefix('test-job-123') == 'aws-batch-auditor/default/0123abcd'
+        assert mock_open.call_args.args[0] == 'http://169.254.170.2/v4/abc/task'
+
+def test_get_log_stream_prefix_falls_back_to_job_id():
+    """Test the job ID is used when not running with awslogs task metadata."""
+    from src.main import get_log_stream_prefix
+    
+    with patch.dict(os.environ, {'ECS_CONTAINER_METADATA_URI_V4': '', 'AWS_BATCH_LOG_STREAM_PREFIX': ''}):
+        assert get_log_stream_prefix('test-job-123') == 'test-job-123'
+
+def test_generate_audit_report():
     """Test audit report generation."""
     from src.main import generate_audit_report
     
     # Mock EC2 client
     mock_ec2 = MagicMock()
-    mock_client.return_value = mock_ec2
     
     # Mock instances data
     mock_instances = [
@@ -128,12 +260,13 @@ def test_generate_audit_report(mock_client):
     ]
     
     # Mock security group response
-    mock_ec2.describe_security_group_rules.return_value = {
+    mock_ec2.get_paginator.return_value.paginate.return_value = [{
         'SecurityGroupRules': []
-    }
+    }]
     
-    report = generate_audit_report(mock_ec2, mock_instances)
+    report = generate_audit_report(mock_ec2, mock_instances, RUN_TIME)
     
     assert report['summary']['total_instances'] == 1
+    assert report['summary']['instance_list_complete'] is True
     assert 'audit_timestamp' in report
     assert 'findings' in report
\ No newline at end of file
@@ -4,6 +4,7 @@
 import json
 import os
 import sys
+from datetime import datetime, timezone
 from unittest.mock import Mock, patch
 
 # Add the project root directory to Python path
@@ -11,35 +12,58 @@ project_root = os.path.join(os.path.dirname(__file__), '../..')
 sys.path.insert(0, project_root)
 
 # Import functions to test
-from src.main import check_security_groups, check_instance_utilization, generate_audit_report
+from src.main import (
+    SG_FILTER_CHUNK_SIZE,
+    check_instance_utilization,
+    dumps_report,
+    format_timestamp,
+    generate_audit_report,
+    get_security_group_issues,
+    scan_log_events,
+)
 
-def test_check_security_groups():
+RUN_TIME = datetime(2024, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+def test_get_security_group_issues():
     """Test security group checking logic."""
     mock_ec2 = Mock()
-    mock_instance = {
-        'InstanceId': 'i-1234567890abcdef0',
-        'SecurityGroups': [{'GroupId': 'sg-12345678'}]
-    }
     
-    # Mock security group rules response as a dictionary, not a Mock object
-    mock_ec2.describe_security_group_rules.return_value = {
+    # Mock a single page of security group rules as a dictionary, not a Mock object
+    mock_ec2.get_paginator.return_value.paginate.return_value = [{
         'SecurityGroupRules': [
             {
+                'GroupId': 'sg-12345678',
                 'FromPort': 22,
                 'IpProtocol': 'tcp',
                 'CidrIpv4': '0.0.0.0/0'
             },
             {
+                'GroupId': 'sg-12345678',
                 'FromPort': 80,
                 'IpProtocol': 'tcp',
                 'CidrIpv4': '0.0.0.0/0'
             }
         ]
-    }
+    }]
     
-    issues = check_security_groups(mock_ec2, mock_instance)
-    assert len(issues) == 1
-    assert issues[0]['Port'] == 22
+    sg_issues = get_security_group_issues(mock_ec2, ['sg-12345678'])
+    assert len(sg_issues['sg-12345678']) == 1
+    assert sg_issues['sg-12345678'][0].port == 22
+
+def test_get_security_group_issues_chunks_filter_values():
+    """Test security group IDs are split to respect the EC2 filter limit."""
+    mock_ec2 = Mock()
+    mock_ec2.get_paginator.return_value.paginate.return_value = []
+    
+    sg_ids = [f'sg-{i:08d}' for i in range(SG_FILTER_CHUNK_SIZE + 1)]
+    get_security_group_issues(mock_ec2, sg_ids)
+    
+    # Chunks are fetched concurrently, so compare them independent of call order
+    calls = mock_ec2.get_paginator.return_value.paginate.call_args_list
+    chunks = sorted((c.kwargs['Filters'][0]['Values'] for c in calls), key=len)
+    assert len(chunks) == 2
+    assert chunks[0] == [sg_ids[-1]]
+    assert chunks[1] == sg_ids[:SG_FILTER_CHUNK_SIZE]
 
 def test_check_instance_utilization():
     """Test instance utilization checking logic."""
@@ -66,6 +90,22 @@ def test_check_instance_utilization():
     assert len(issues) == 1
     assert issues[0]['issue'] == 'NON_FREE_TIER_TYPE'
 
+def test_get_security_group_issues_merges_in_chunk_order():
+    """Test findings from concurrent chunks are merged in a stable order."""
+    mock_ec2 = Mock()
+    sg_ids = [f'sg-{i:08d}' for i in range(2 * SG_FILTER_CHUNK_SIZE)]
+    
+    def pages(Filters):
+        # Report every group in the chunk as open to SSH
+        return [{'SecurityGroupRules': [
+            {'GroupId': sg_id, 'FromPort': 22, 'IpProtocol': 'tcp', 'CidrIpv4': '0.0.0.0/0'}
+            for sg_id in Filters[0]['Values']
+        ]}]
+    
+    mock_ec2.get_paginator.return_value.paginate.side_effect = pages
+    
+    assert list(get_security_group_issues(mock_ec2, sg_ids)) == sg_ids
+
 def test_generate_audit_report():
     """Test audit report generation."""
     mock_ec2 = Mock()
@@ -78,29 +118,90 @@ def test_generate_audit_report():
         }
     ]
     
-    # Mock the security group rules response as a dictionary
-    mock_security_response = {
-        'SecurityGroupRules': []  # Empty list means no security issues
-    }
-    
-    # Mock the describe_security_group_rules method to return our dictionary
-    mock_ec2.describe_security_group_rules.return_value = mock_security_response
-    
     # Mock the individual check functions to return no issues
-    with patch('src.main.check_security_groups') as mock_security_check:
+    with patch('src.main.get_security_group_issues') as mock_security_check:
         with patch('src.main.check_instance_utilization') as mock_utilization_check:
-            # Configure the mocks to return empty lists (no issues)
-            mock_security_check.return_value = []
+            # Configure the mocks to return no issues
+            mock_security_check.return_value = {}
             mock_utilization_check.return_value = []
             
-            report = generate_audit_report(mock_ec2, instances)
+            report = generate_audit_report(mock_ec2, instances, RUN_TIME)
             
+            mock_security_check.assert_called_once()
             assert report['summary']['total_instances'] == 1
             assert report['summary']['instances_with_security_issues'] == 0
             assert report['summary']['instances_with_utilization_issues'] == 0
 
+def test_generate_audit_report_shared_security_group():
+    """Test a risky security group is reported for every instance using it."""
+    mock_ec2 = Mock()
+    instances = [
+        {
+            'InstanceId': f'i-{i}',
+            'State': {'Name': 'running'},
+            'SecurityGroups': [{'GroupId': 'sg-12345678'}],
+            'InstanceType': 't2.micro'
+        }
+        for i in range(2)
+    ]
+    mock_ec2.get_paginator.return_value.paginate.return_value = [{
+        'SecurityGroupRules': [
+            {
+                'GroupId': 'sg-12345678',
+                'FromPort': 3389,
+                'IpProtocol': 'tcp',
+                'CidrIpv4': '0.0.0.0/0'
+            }
+        ]
+    }]
+    
+    report = generate_audit_report(mock_ec2, instances, RUN_TIME)
+    
+    mock_ec2.get_paginator.return_value.paginate.assert_called_once()
+    assert report['summary']['instances_with_security_issues'] == 2
+    assert [f['instance_id'] for f in report['findings']['security_issues']] == ['i-0', 'i-1']
+    
+    # Findings keep the report's JSON shape when serialized
+    serialized = json.loads(dumps_report(report))
+    assert serialized['findings']['security_issues'][0]['issues'] == [{
+        'SecurityGroupId': 'sg-12345678',
+        'Port': 3389,
+        'Protocol': 'tcp',
+        'CIDR': '0.0.0.0/0'
+    }]
+
+def test_scan_log_events_counts_every_page():
+    """Test log markers are counted across all pages, not just the first."""
+    mock_logs = Mock()
+    
+    # Pages are yielded lazily, as the boto3 paginator does
+    mock_logs.get_paginator.return_value.paginate.return_value = (
+        {'events': [{'message': f'ERROR: failure {i}'}, {'message': 'WARNING: slow'}]}
+        for i in range(50)
+    )
+    
+    analysis = scan_log_events(mock_logs, '/aws/batch/job', 'test-job-123', 0)
+    assert analysis['total_log_events'] == 100
+    assert analysis['error_count'] == 50
+    assert analysis['warning_count'] == 50
+    assert analysis['first_log_event'] == 'ERROR: failure 0'
+    assert analysis['last_log_event'] == 'WARNING: slow'
+    assert analysis['successful_completion'] is False
+
+def test_format_timestamp_matches_json_reports():
+    """Test Markdown timestamps match the JSON report rendering."""
+    for timestamp in (RUN_TIME, RUN_TIME.replace(microsecond=123456)):
+        serialized = json.loads(dumps_report({'audit_timestamp': timestamp}))
+        assert format_timestamp(timestamp) == serialized['audit_timestamp']
+    assert format_timestamp(RUN_TIME) == '2024-01-01T12:00:00Z'
+
 if __name__ == '__main__':
-    test_check_security_groups()
+    test_get_security_group_issues()
+    test_get_security_group_issues_chunks_filter_values()
     test_check_instance_utilization()
+    test_get_security_group_issues_merges_in_chunk_order()
     test_generate_audit_report()
+    test_generate_audit_report_shared_security_group()
+    test_scan_log_events_counts_every_page()
+    test_format_timestamp_matches_json_reports()
     print("All unit tests passed!")
\ No newline at end of file